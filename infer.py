@@ -65,7 +65,7 @@ def main():
 
     # Load trained model
     g = tf.get_default_graph()
-    saver = tf.train.import_meta_graph(tf.train.latest_checkpoint(config.model_dir) + '.meta')
+    saver = tf.train.import_meta_graph(tf.train.latest_checkpoint(config.model_dir) + '.meta', clear_devices=True)
     saver.restore(sess, tf.train.latest_checkpoint(config.model_dir))
     action_prob_tran = g.get_collection('action_prob_tran')[0]  # translation classification probability
     ytr = g.get_collection('ytr')[0]                            # translation regression (displacement vector)
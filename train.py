@@ -16,6 +16,10 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+# Give each GPU its own host threads to launch kernels, so that they are not delayed by the input pipeline threads.
+# Must be set before Tensorflow initialises the GPUs
+os.environ.setdefault('TF_GPU_THREAD_MODE', 'gpu_private')
+os.environ.setdefault('TF_GPU_THREAD_COUNT', '2')
 import numpy as np
 import tensorflow as tf
 from utils import input_data, network, geometry, plane
@@ -38,10 +42,16 @@ class Config(object):
     # Training parameters
     resume = True                              # Whether to train from scratch or resume previous training
     learning_rate = 0.001
+    optimizer = 'adam'                          # Optimizer: 'adam' or 'momentum'. Momentum keeps one slot per weight instead of two. Changing it requires training from scratch
+    momentum = 0.9                              # Momentum of the 'momentum' optimizer
     max_steps = 10000                           # Number of steps to train
     save_interval = 2500                        # Number of steps in between saving each model
     batch_size = 64                             # Training batch size
     dropout = 0.5
+    num_gpus = 1                                # Number of GPUs to split each mini-batch across
+    use_amp = False                             # Whether to use automatic mixed precision (Tensorflow >= 1.14 and a GPU with tensor cores)
+    num_parallel_calls = 4                      # Number of threads sampling training pairs in the input pipeline
+    prefetch_size = 2                           # Number of mini-batches prefetched by the input pipeline
     # Parameters for sampling training plane
     trans_frac = 0.6                            # Percentage of middle volume to sample plane centre from. (0-1)
     max_euler = [45.0/180.0*np.pi,              # Maximum range to sample the three Euler angles in radians for plane orientation.
@@ -68,24 +78,51 @@ def main():
                                      config.test_list_file,
                                      config.landmark_count,
                                      config.plane_name)
+    # Stage images into contiguous zero-padded arrays for fast sampling of training pairs
+    data.train.images, data.train.shapes = input_data.stack_images(data.train.images)
+    data.test.images, data.test.shapes = input_data.stack_images(data.test.images)
+    # Store images as 8-bit intensities to reduce memory and the bytes copied per mini-batch.
+    # Network inputs are converted back to the original intensity range in the graph
+    intensity_scale = float(max(data.train.images.max(), data.test.images.max())) / 255.0 or 1.0
+    data.train.images = input_data.quantize_images(data.train.images, intensity_scale)
+    data.test.images = input_data.quantize_images(data.test.images, intensity_scale)
+    # Plane centres are sampled uniformly from tran_low to tran_low + tran_scale of each image (volume centre as origin)
+    data.train.tran_scale = data.train.shapes * config.trans_frac
+    data.train.tran_low = data.train.shapes * (1-config.trans_frac) / 2.0 - (data.train.shapes-1) / 2.0
+    data.test.tran_scale = data.test.shapes * config.trans_frac
+    data.test.tran_low = data.test.shapes * (1-config.trans_frac) / 2.0 - (data.test.shapes-1) / 2.0
 
     # Build graph
     print("Building graph...")
-    # Input placeholders
+    # Input pipeline. Training pairs are sampled in background threads and fed through a feedable iterator,
+    # so the same graph can be run on either the train or the test set.
     with tf.name_scope('input'):
-        x = tf.placeholder(tf.float32, [None, config.box_size[0], config.box_size[1], config.input_plane], name='x-input')
+        train_dataset = make_dataset(config, data.train)
+        test_dataset = make_dataset(config, data.test)
+        handle = tf.placeholder(tf.string, shape=[], name='handle')
+        iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types, train_dataset.output_shapes)
+        train_iterator = train_dataset.make_one_shot_iterator()
+        test_iterator = test_dataset.make_one_shot_iterator()
+        slices, actions_tran, trans_diff, actions_rot, rots_diff = iterator.get_next()
+        slices = tf.cast(slices, tf.float32) * intensity_scale
+
+        # Network inputs default to the pipeline outputs but can still be fed directly (eg. during inference)
+        x = tf.placeholder_with_default(slices, [None, config.box_size[0], config.box_size[1], config.input_plane], name='x-input')
         tf.add_to_collection('x', x)
-        ytc_ = tf.placeholder(tf.float32, [None, num_output_tc], name='ytc-input')     # translation classification output
+        ytc_ = tf.placeholder_with_default(actions_tran, [None, num_output_tc], name='ytc-input')     # translation classification output
         tf.add_to_collection('ytc_', ytc_)
-        ytr_ = tf.placeholder(tf.float32, [None, num_output_tr], name='ytr-input')     # translation regression output
+        ytr_ = tf.placeholder_with_default(trans_diff, [None, num_output_tr], name='ytr-input')      # translation regression output
         tf.add_to_collection('ytr_', ytr_)
-        yrc_ = tf.placeholder(tf.float32, [None, num_output_rc], name='yrc-input')     # rotation classification prob output
+        yrc_ = tf.placeholder_with_default(actions_rot, [None, num_output_rc], name='yrc-input')     # rotation classification prob output
         tf.add_to_collection('yrc_', yrc_)
-        yrr_ = tf.placeholder(tf.float32, [None, num_output_rr], name='yrr-input')     # rotation regression (quaternions) output
+        yrr_ = tf.placeholder_with_default(rots_diff, [None, num_output_rr], name='yrr-input')       # rotation regression (quaternions) output
         tf.add_to_collection('yrr_', yrr_)
 
-    # Define CNN model
-    ytc, ytr, yrc, yrr, keep_prob = network.cnn(x, config.input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr)
+    # Define CNN model. With several GPUs, each GPU runs a tower of the model on part of the mini-batch
+    if config.num_gpus > 1:
+        ytc, ytr, yrc, yrr, keep_prob = network.cnn_multi_gpu(x, config.input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr, config.num_gpus)
+    else:
+        ytc, ytr, yrc, yrr, keep_prob = network.cnn(x, config.input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr)
     tf.add_to_collection('ytc', ytc)
     tf.add_to_collection('ytr', ytr)
     tf.add_to_collection('yrc', yrc)
@@ -106,13 +143,13 @@ def main():
     # Define loss
     with tf.name_scope('loss'):
         # Weightings for each loss term
-        alpha = tf.placeholder(tf.float32, name='alpha')
+        alpha = tf.constant(config.alpha, tf.float32, name='alpha')
         tf.add_to_collection('alpha', alpha)
-        beta = tf.placeholder(tf.float32, name='beta')
+        beta = tf.constant(config.beta, tf.float32, name='beta')
         tf.add_to_collection('beta', beta)
-        gamma = tf.placeholder(tf.float32, name='gamma')
+        gamma = tf.constant(config.gamma, tf.float32, name='gamma')
         tf.add_to_collection('gamma', gamma)
-        delta = tf.placeholder(tf.float32, name='delta')
+        delta = tf.constant(config.delta, tf.float32, name='delta')
         tf.add_to_collection('delta', delta)
 
         # translation classification loss (cross entropy)
@@ -122,7 +159,7 @@ def main():
         tf.summary.scalar('loss_tc', loss_tc)
 
         # translation regresssion loss (MSE)
-        loss_tr = tf.reduce_sum(tf.pow(ytr_ - ytr, 2), axis=1)
+        loss_tr = tf.reduce_sum(tf.square(ytr_ - ytr), axis=1)
         loss_tr = tf.reduce_mean(loss_tr)
         tf.add_to_collection('loss_tr', loss_tr)
         tf.summary.scalar('loss_tr', loss_tr)
@@ -134,9 +171,9 @@ def main():
         tf.summary.scalar('loss_rc', loss_rc)
 
         # rotation regression loss (MSE)
-        yrr_norm = yrr / tf.expand_dims(tf.sqrt(tf.reduce_sum(tf.pow(yrr, 2), axis=1)), axis=1)
+        yrr_norm = tf.nn.l2_normalize(yrr, axis=1, epsilon=1e-12)
         tf.add_to_collection('yrr_norm', yrr_norm)
-        loss_rr = tf.reduce_sum(tf.pow(yrr_ - yrr_norm, 2), axis=1)
+        loss_rr = tf.reduce_sum(tf.square(yrr_ - yrr_norm), axis=1)
         loss_rr = tf.reduce_mean(loss_rr)
         tf.add_to_collection('loss_rr', loss_rr)
         tf.summary.scalar('loss_rr', loss_rr)
@@ -155,7 +192,17 @@ def main():
         # train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss, global_step=global_step)
         # tf.summary.scalar('learning_rate', learning_rate)
         # Constant learning rate
-        train_step = tf.train.AdamOptimizer(config.learning_rate).minimize(loss)
+        if config.optimizer == 'adam':
+            optimizer = tf.train.AdamOptimizer(config.learning_rate)
+        elif config.optimizer == 'momentum':
+            optimizer = tf.train.MomentumOptimizer(config.learning_rate, config.momentum)
+        else:
+            raise ValueError("Invalid optimizer. Must be 'adam' or 'momentum'.")
+        if config.use_amp:
+            # Run convolutions and matmuls in FP16 with dynamic loss scaling. Losses and weight updates stay in FP32
+            optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer, loss_scale='dynamic')
+        # Gradients of each tower are computed on the GPU running the tower
+        train_step = optimizer.minimize(loss, colocate_gradients_with_ops=True)
         tf.add_to_collection('train_step', train_step)
 
     with tf.name_scope('performance'):
@@ -175,7 +222,9 @@ def main():
 
     # Run training
     print("Start training...")
-    sess = tf.InteractiveSession()
+    sess_config = tf.ConfigProto(allow_soft_placement=True)
+    sess_config.gpu_options.allow_growth = True
+    sess = tf.InteractiveSession(config=sess_config)
     merged = tf.summary.merge_all()
     train_writer = tf.summary.FileWriter(config.log_dir + '/train', sess.graph)
     test_writer = tf.summary.FileWriter(config.log_dir + '/test')
@@ -194,52 +243,27 @@ def main():
         ite_start = 0
         ite_end = config.max_steps
 
-    for i in xrange(ite_start, ite_end):
-        slices_train, actions_tran_train, tran_diff_train, actions_rot_train, rot_diff_train = get_train_pairs(config, data.train)
+    train_handle, test_handle = sess.run([train_iterator.string_handle(), test_iterator.string_handle()])
+
+    # Callables for each kind of step, to avoid resolving fetches and feeds on every sess.run
+    metrics = [merged, loss, loss_tc, accuracy_tran, loss_tr, loss_rc, accuracy_rot, loss_rr]
+    train_fn = sess.make_callable(train_step, feed_list=[handle, keep_prob])
+    train_metrics_fn = sess.make_callable([train_step] + metrics, feed_list=[handle, keep_prob])
+    metrics_fn = sess.make_callable(metrics, feed_list=[handle, keep_prob])
 
+    for i in xrange(ite_start, ite_end):
         if i % 10 == 0:
             # Record summaries and test-set loss
-            slices_test, actions_tran_test, tran_diff_test, actions_rot_test, rot_diff_test = get_train_pairs(config, data.test)
-
-            summary_test, l_test, ltc_test, acc_t_test, ltr_test, lrc_test, acc_r_test, lrr_test = sess.run([merged, loss, loss_tc, accuracy_tran, loss_tr, loss_rc, accuracy_rot, loss_rr],
-                                                                                                            feed_dict={x: slices_test,
-                                                                                                                       ytc_: actions_tran_test,
-                                                                                                                       ytr_: tran_diff_test,
-                                                                                                                       yrc_: actions_rot_test,
-                                                                                                                       yrr_: rot_diff_test,
-                                                                                                                       alpha: config.alpha,
-                                                                                                                       beta: config.beta,
-                                                                                                                       gamma: config.gamma,
-                                                                                                                       delta: config.delta,
-                                                                                                                       keep_prob: 1.0})
+            summary_test, l_test, ltc_test, acc_t_test, ltr_test, lrc_test, acc_r_test, lrr_test = metrics_fn(test_handle, 1.0)
             test_writer.add_summary(summary_test, i)
-            # Record summaries and train-set loss
-            summary_train, l_train, ltc_train, acc_t_train, ltr_train, lrc_train, acc_r_train, lrr_train = sess.run([merged, loss, loss_tc, accuracy_tran, loss_tr, loss_rc, accuracy_rot, loss_rr],
-                                                                                                                    feed_dict={x: slices_train,
-                                                                                                                               ytc_: actions_tran_train,
-                                                                                                                               ytr_: tran_diff_train,
-                                                                                                                               yrc_: actions_rot_train,
-                                                                                                                               yrr_: rot_diff_train,
-                                                                                                                               alpha: config.alpha,
-                                                                                                                               beta: config.beta,
-                                                                                                                               gamma: config.gamma,
-                                                                                                                               delta: config.delta,
-                                                                                                                               keep_prob: 1.0})
+            # Train one step, recording summaries and train-set loss from the same forward pass (with dropout)
+            _, summary_train, l_train, ltc_train, acc_t_train, ltr_train, lrc_train, acc_r_train, lrr_train = train_metrics_fn(train_handle, config.dropout)
             train_writer.add_summary(summary_train, i)
             print('Step {}: \ttrain: loss={:11.6f} loss_tc={:11.6f} acc_t={:8.6f} loss_tr={:11.6f} loss_rc={:11.6f} acc_r={:8.6f} loss_rr={:11.6f}. \ttest: loss={:11.6f} loss_tc={:11.6f} acc_t={:8.6f} loss_tr={:11.6f} loss_rc={:11.6f} acc_r={:8.6f} loss_rr={:11.6f}.'.format
                   (i, l_train, ltc_train, acc_t_train, ltr_train, lrc_train, acc_r_train, lrr_train, l_test, ltc_test, acc_t_test, ltr_test, lrc_test, acc_r_test, lrr_test))
-
-        # Train one step
-        _ = sess.run(train_step, feed_dict={x: slices_train,
-                                            ytc_: actions_tran_train,
-                                            ytr_: tran_diff_train,
-                                            yrc_: actions_rot_train,
-                                            yrr_: rot_diff_train,
-                                            alpha: config.alpha,
-                                            beta: config.beta,
-                                            gamma: config.gamma,
-                                            delta: config.delta,
-                                            keep_prob: config.dropout})
+        else:
+            # Train one step
+            train_fn(train_handle, config.dropout)
 
         # Save trained model
         if ((i+1) % config.save_interval) == 0:
@@ -251,22 +275,66 @@ def main():
     sess.close()
 
 
-def get_train_pairs(config, data):
+def make_dataset(config, data):
+    """Build the input pipeline that samples training pairs from a dataset.
+
+    Mini-batches are sampled by get_train_pairs in config.num_parallel_calls background threads and
+    prefetched, so that plane extraction on the CPU overlaps with training on the GPU.
+
+    Args:
+      config: training configurations
+      data: DataSet to sample the images from
+
+    Returns:
+      dataset: tf.data.Dataset of mini-batches (slices, actions_tran, trans_diff, actions_rot, rots_diff). See get_train_pairs.
+
+    """
+    img_count = len(data.images)
+    output_types = [tf.uint8, tf.float32, tf.float32, tf.float32, tf.float32]
+    output_shapes = [[config.box_size[0], config.box_size[1], config.input_plane], [6], [3], [6], [4]]
+
+    # Identity plane (or orthogonal planes) is the same for every training pair, so initialise it only once
+    if config.input_plane == 1:
+        mesh_init = np.expand_dims(plane.init_mesh_by_plane(config.box_size, 'z'), axis=0)
+    elif config.input_plane == 3:
+        mesh_init = plane.init_mesh_ortho(config.box_size)
+
+    def sample_fn(ind):
+        # Each mini-batch gets fresh arrays, since earlier ones may still be queued in the pipeline. Avoid copying those already in the output type
+        outputs = tf.py_func(lambda ind: [output.astype(dtype.as_numpy_dtype, copy=False)
+                                          for output, dtype in zip(get_train_pairs(config, data, ind, mesh_init), output_types)],
+                             [ind], output_types)
+        for output, shape in zip(outputs, output_shapes):
+            output.set_shape([config.batch_size] + shape)
+        return tuple(outputs)
+
+    dataset = tf.data.Dataset.range(img_count)
+    dataset = dataset.shuffle(img_count).repeat()
+    dataset = dataset.batch(config.batch_size)
+    dataset = dataset.map(sample_fn, num_parallel_calls=config.num_parallel_calls)
+    dataset = dataset.prefetch(config.prefetch_size)
+    return dataset
+
+
+def get_train_pairs(config, data, ind, mesh_init):
     """Prepare training data.
 
     Args:
       batch_size: mini batch size
-      images: list of img_count images. Each image is [width, height, depth, channel], [x,y,z,channel]
+      images: img_count images zero-padded to the same size. 8-bit intensities. [img_count, x, y, z]
+      shapes: size of each image. [img_count, 3]
+      tran_low, tran_scale: range to sample the plane centre of each image from. [img_count, 3]
       trans_gt: 3D centre point of the ground truth plane wrt the volume centre as origin. [2, img_count, 3]. first dimension is the tv(0) or tc(1) plane
       rots_gt: Quaternions that rotate xy-plane to the GT plane. [2, img_count, 4]. first dimension is the tv(0) or tc(1) plane
-      trans_frac: Percentage of middle volume to sample translation vector from. (0-1)
       max_euler: Maximum range of Euler angles to sample from. (+/- max_euler). [3]
       box_size: size of 2D plane. [x,y].
       input_plane: number of input planes (1 or 3)
       plane: TV(0) or TC(1)
+      ind: indices of the images to sample the mini-batch from. [batch_size]
+      mesh_init: mesh coordinates of the identity plane or the three orthogonal planes. [input_plane, 4, num_mesh_pts]
 
     Returns:
-      slices: 2D plane images. [batch_size, box_size[0], box_size[1], input_plane]
+      slices: 2D plane images. Same data type as images. [batch_size, box_size[0], box_size[1], input_plane]
       actions_tran: [batch_size, 6] the GT classification probability for translation. Hard label, one-hot vector. Gives the axis about which to translate, ie. axis with biggest distance to GT
       trans_diff: [batch_size, 3]. 3D centre point of the ground truth plane wrt the centre of the randomly sampled plane as origin.
       actions_rot:[batch_size, 6] the GT classification probability for rotation. Hard label, one-hot vector. Gives the axis about which to rotate, ie. rotation axis with biggest rotation angle.
@@ -274,104 +342,56 @@ def get_train_pairs(config, data):
 
     """
     images = data.images
+    shapes = data.shapes
+    tran_low = data.tran_low
+    tran_scale = data.tran_scale
     trans_gt = data.trans_vecs
     rots_gt = data.quats
-    batch_size = config.batch_size
+    batch_size = len(ind)
     box_size = config.box_size
-    input_plane = config.input_plane
-    trans_frac = config.trans_frac
     max_euler = config.max_euler
 
-    img_count = len(images)
-    slices = np.zeros((batch_size, box_size[0], box_size[1], input_plane), np.float32)
-    trans_diff = np.zeros((batch_size, 3))
-    trans = np.zeros((batch_size, 3))
-    rots_diff = np.zeros((batch_size, 4))
-    rots = np.zeros((batch_size, 4))
-    euler = np.zeros((batch_size, 6, 3))    # 6 Euler angle conventions. 'sxyz', 'sxzy', 'syxz', 'syzx', 'szxy', 'szyx'
     actions_tran = np.zeros((batch_size, 6), np.float32)
     actions_rot = np.zeros((batch_size, 6), np.float32)
 
-    # get image indices randomly for a mini-batch
-    ind = np.random.randint(img_count, size=batch_size)
+    # Draw all random numbers of the mini-batch at once. First three for the rotations and last three for the translations
+    rand = np.random.rand(batch_size, 6)
 
     # Random uniform sampling of Euler angles with restricted range
-    euler_angles = geometry.sample_euler_angles_fix_range(batch_size, max_euler[0], max_euler[1], max_euler[2])
-
-    for i in xrange(batch_size):
-        image = np.squeeze(images[ind[i]])
-        img_siz = np.array(image.shape)
-
-        # GT translation and quaternions
-        tran_gt = trans_gt[ind[i], :]
-        rot_gt = rots_gt[ind[i], :]
-
-        # Randomly sample translation (plane centre) and quaternions
-        tran = (np.random.rand(3) * (img_siz * trans_frac) + img_siz * (1-trans_frac) / 2.0) - ((img_siz-1) / 2.0)
-        trans[i, :] = tran
-        rot = geometry.quaternion_from_euler(euler_angles[i, 0], euler_angles[i, 1], euler_angles[i, 2], 'rxyz')
-        rots[i, :] = rot
-
-
-        ##### Extract plane image #####
-        # Initialise identity plane and get orthogonal planes
-        if input_plane == 1:
-            xyz_coords = plane.init_mesh_by_plane(box_size, 'z')
-        elif input_plane == 3:
-            xyz_coords = plane.init_mesh_ortho(box_size)
-
-        # Rotate and translate plane
-        mat = geometry.quaternion_matrix(rot)
-        mat[:3, 3] = tran
-        xyz_coords = np.matmul(mat, xyz_coords)
-
-        # Extract image plane
-        if input_plane == 1:
-            slices[i, :, :, 0], _ = plane.extract_plane_from_mesh(image, xyz_coords, box_size, 1)
-        elif input_plane == 3:
-            slice_single, _ = plane.extract_plane_from_mesh_batch(image, xyz_coords, box_size, 1)
-            slices[i] = np.transpose(slice_single, (1, 2, 0))
-
-
-        ##### Compute GT labels #####
-        # Translation and rotation regression outputs. Compute difference in tran and quat between sampled plane and GT plane (convert to rotation matrices first)
-        mat_inv = geometry.inv_mat(mat)
-        mat_gt = geometry.quaternion_matrix(rot_gt)
-        mat_gt[:3, 3] = tran_gt
-        mat_diff = np.matmul(mat_inv, mat_gt)
-        trans_diff[i, :] = mat_diff[:3, 3]
-        rots_diff[i, :] = geometry.quaternion_from_matrix(mat_diff, isprecise=True)
-
-        # Rotation classification output. Compute Euler angles for the six different conventions
-        euler[i, 0, :] = np.array(geometry.euler_from_matrix(mat_diff, axes='sxyz'))
-        euler[i, 1, :] = np.array(geometry.euler_from_matrix(mat_diff, axes='sxzy'))
-        euler[i, 2, :] = np.array(geometry.euler_from_matrix(mat_diff, axes='syxz'))
-        euler[i, 3, :] = np.array(geometry.euler_from_matrix(mat_diff, axes='syzx'))
-        euler[i, 4, :] = np.array(geometry.euler_from_matrix(mat_diff, axes='szxy'))
-        euler[i, 5, :] = np.array(geometry.euler_from_matrix(mat_diff, axes='szyx'))
-
-    # Rotation classification output.
-    max_ind_rot = np.argmax(np.abs(euler[:, :, 0]), axis=1)
-    rot_x_max = np.logical_or(max_ind_rot == 0, max_ind_rot == 1)
-    rot_y_max = np.logical_or(max_ind_rot == 2, max_ind_rot == 3)
-    rot_z_max = np.logical_or(max_ind_rot == 4, max_ind_rot == 5)
-    actions_ind_rot = np.zeros((batch_size), dtype=np.uint16)
-    actions_ind_rot[rot_x_max] = 0
-    actions_ind_rot[rot_y_max] = 1
-    actions_ind_rot[rot_z_max] = 2
-    max_euler = euler[np.arange(batch_size), max_ind_rot, np.zeros(batch_size, dtype=np.uint16)]   # [batch_size]
-    is_positive = (max_euler > 0)
-    actions_ind_rot[is_positive] = actions_ind_rot[is_positive] * 2
-    actions_ind_rot[np.logical_not(is_positive)] = actions_ind_rot[np.logical_not(is_positive)] * 2 + 1
+    euler_angles = geometry.euler_angles_fix_range(rand[:, :3], max_euler[0], max_euler[1], max_euler[2])
+
+    # Quaternions and transformation matrices of the randomly sampled planes
+    rots = geometry.quaternion_from_euler_batch(euler_angles, 'rxyz')
+    mats = geometry.quaternion_matrix_batch(rots)
+
+    # Randomly sample translations (plane centres)
+    mats[:, :3, 3] = rand[:, 3:] * tran_scale[ind] + tran_low[ind]
+
+    ##### Extract plane images #####
+    slices = plane.extract_plane_from_mesh_batch_multi(images, shapes, ind, mats, mesh_init, box_size)
+
+
+    ##### Compute GT labels #####
+    # Translation and rotation regression outputs. Compute difference in tran and rotation between sampled plane and GT plane.
+    # For rigid transformations, inv(mat) * mat_gt = [R^T * R_gt, R^T * (t_gt - t)], so the inverse is never formed
+    rot_mats_inv = np.transpose(mats[:, :3, :3], (0, 2, 1))
+    rot_mats_diff = np.matmul(rot_mats_inv, geometry.quaternion_matrix_batch(rots_gt[ind])[:, :3, :3])
+    trans_diff = np.einsum('bij,bj->bi', rot_mats_inv, trans_gt[ind] - mats[:, :3, 3])
+    rots_diff = geometry.quaternion_from_matrix_batch(rot_mats_diff)
+
+    # Rotation classification output. Compute the first Euler angle for the six different conventions. [batch_size, 6]
+    euler = np.stack([geometry.euler_first_angle_from_matrix_batch(rot_mats_diff, axes=axes) for axes in ('sxyz', 'sxzy', 'syxz', 'syzx', 'szxy', 'szyx')], axis=1)
+
+    # Rotation classification output. Action index is 2*axis for a positive rotation and 2*axis+1 otherwise
+    max_ind_rot = np.argmax(np.abs(euler), axis=1)     # [batch_size]. Convention (0-5), two conventions per first axis
+    max_euler = euler[np.arange(batch_size), max_ind_rot]    # [batch_size]
+    actions_ind_rot = ((max_ind_rot >> 1) << 1) | (max_euler <= 0)
     actions_rot[np.arange(batch_size), actions_ind_rot] = 1
 
-    # Translation classification output
+    # Translation classification output. Action index is 2*axis for a positive translation and 2*axis+1 otherwise
     max_ind_tran = np.argmax(np.abs(trans_diff), axis=1)     # [batch_size]
     max_trans_diff = trans_diff[np.arange(batch_size), max_ind_tran]   # [batch_size]
-    is_positive = (max_trans_diff > 0)
-    actions_ind_tran = np.zeros((batch_size), dtype=np.uint16)
-    actions_ind_tran[is_positive] = max_ind_tran[is_positive] * 2
-    actions_ind_tran[np.logical_not(is_positive)] = max_ind_tran[np.logical_not(is_positive)] * 2 + 1
+    actions_ind_tran = (max_ind_tran << 1) | (max_trans_diff <= 0)
     actions_tran[np.arange(batch_size), actions_ind_tran] = 1
 
     return slices, actions_tran, trans_diff, actions_rot, rots_diff
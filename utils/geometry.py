@@ -130,6 +130,38 @@ def quaternion_matrix(quaternion):
         [                0.0,                 0.0,                 0.0, 1.0]])
 
 
+def quaternion_matrix_batch(quaternions):
+    """Return homogeneous rotation matrices from a batch of quaternions.
+
+    quaternions : [num, 4]
+
+    Returns matrices [num, 4, 4]
+
+    """
+    q = np.array(quaternions, dtype=np.float64, copy=True)
+    n = np.sum(q*q, axis=1)
+    valid = n >= _EPS
+    q[valid] *= np.sqrt(2.0 / n[valid])[:, np.newaxis]
+    # Components as contiguous vectors, so that each product below is a single vectorised loop
+    w, x, y, z = np.ascontiguousarray(q.T)
+    xx, yy, zz = x*x, y*y, z*z
+    xy, xz, yz = x*y, x*z, y*z
+    wx, wy, wz = w*x, w*y, w*z
+    M = np.zeros((q.shape[0], 4, 4))
+    M[:, 0, 0] = 1.0-yy-zz
+    M[:, 0, 1] = xy-wz
+    M[:, 0, 2] = xz+wy
+    M[:, 1, 0] = xy+wz
+    M[:, 1, 1] = 1.0-xx-zz
+    M[:, 1, 2] = yz-wx
+    M[:, 2, 0] = xz-wy
+    M[:, 2, 1] = yz+wx
+    M[:, 2, 2] = 1.0-xx-yy
+    M[:, 3, 3] = 1.0
+    M[~valid] = np.identity(4)
+    return M
+
+
 def quaternion_from_matrix(matrix, isprecise=False):
     """Return quaternion from rotation matrix.
 
@@ -183,6 +215,39 @@ def quaternion_from_matrix(matrix, isprecise=False):
     return q
 
 
+def quaternion_from_matrix_batch(matrices):
+    """Return quaternions from a batch of precise rotation matrices.
+
+    Vectorised version of quaternion_from_matrix(matrix, isprecise=True) using Shepperd's method.
+
+    matrices : [num, 3, 3] or [num, 4, 4]
+
+    Returns quaternions [num, 4]
+
+    """
+    M = np.array(matrices, dtype=np.float64, copy=False)[:, :3, :3]
+    num = M.shape[0]
+    m00, m01, m02 = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    m10, m11, m12 = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    m20, m21, m22 = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+    # Candidate quaternions (unnormalised) when w, x, y or z is the largest component
+    t = np.stack((1.0+m00+m11+m22,
+                  1.0+m00-m11-m22,
+                  1.0-m00+m11-m22,
+                  1.0-m00-m11+m22), axis=1)
+    q = np.stack((np.stack((t[:, 0], m21-m12, m02-m20, m10-m01), axis=1),
+                  np.stack((m21-m12, t[:, 1], m01+m10, m20+m02), axis=1),
+                  np.stack((m02-m20, m01+m10, t[:, 2], m12+m21), axis=1),
+                  np.stack((m10-m01, m20+m02, m12+m21, t[:, 3]), axis=1)), axis=1)
+    # Choose the candidate with the same branching as quaternion_from_matrix
+    i = np.where(m11 > m00, 1, 0)
+    i = np.where(m22 > M[np.arange(num), i, i], 2, i)
+    ind = np.where(m00+m11+m22 > 0.0, 0, i+1)
+    q = q[np.arange(num), ind] * (0.5 / np.sqrt(t[np.arange(num), ind]))[:, np.newaxis]
+    q[q[:, 0] < 0.0] *= -1.0
+    return q
+
+
 def euler_from_quaternion(quaternion, axes='sxyz'):
     """Return Euler angles from quaternion for specified axis sequence.
 
@@ -243,6 +308,63 @@ def quaternion_from_euler(ai, aj, ak, axes='sxyz'):
     return q
 
 
+def quaternion_from_euler_batch(angles, axes='sxyz'):
+    """Return quaternions from a batch of Euler angles and axis sequence.
+
+    angles : Euler's roll, pitch and yaw angles [num, 3]
+    axes : One of 24 axis sequences as string or encoded tuple
+
+    Returns quaternions [num, 4]
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis + 1
+    j = _NEXT_AXIS[i+parity-1] + 1
+    k = _NEXT_AXIS[i-parity] + 1
+
+    angles = np.array(angles, dtype=np.float64, copy=False)
+    ai, aj, ak = angles[:, 0], angles[:, 1], angles[:, 2]
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        aj = -aj
+
+    ai = ai / 2.0
+    aj = aj / 2.0
+    ak = ak / 2.0
+    ci = np.cos(ai)
+    si = np.sin(ai)
+    cj = np.cos(aj)
+    sj = np.sin(aj)
+    ck = np.cos(ak)
+    sk = np.sin(ak)
+    cc = ci*ck
+    cs = ci*sk
+    sc = si*ck
+    ss = si*sk
+
+    q = np.empty((angles.shape[0], 4))
+    if repetition:
+        q[:, 0] = cj*(cc - ss)
+        q[:, i] = cj*(cs + sc)
+        q[:, j] = sj*(cc + ss)
+        q[:, k] = sj*(cs - sc)
+    else:
+        q[:, 0] = cj*cc + sj*ss
+        q[:, i] = cj*sc - sj*cs
+        q[:, j] = cj*ss + sj*cc
+        q[:, k] = cj*cs - sj*sc
+    if parity:
+        q[:, j] *= -1.0
+
+    return q
+
+
 def euler_matrix(ai, aj, ak, axes='sxyz'):
     """Return homogeneous rotation matrix from Euler angles and axis sequence.
 
@@ -341,6 +463,46 @@ def euler_from_matrix(matrix, axes='sxyz'):
     return ax, ay, az
 
 
+def euler_first_angle_from_matrix_batch(matrices, axes='sxyz'):
+    """Return the first Euler angle from a batch of rotation matrices for specified axis sequence.
+
+    Same as [euler_from_matrix(M, axes)[0] for M in matrices], without computing the other two angles.
+
+    matrices : [num, 3, 3] or [num, 4, 4]
+    axes : One of 24 axis sequences as string or encoded tuple
+
+    Returns first Euler angles [num]
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    M = np.array(matrices, dtype=np.float64, copy=False)[:, :3, :3]
+    if repetition:
+        regular = np.sqrt(M[:, i, j]*M[:, i, j] + M[:, i, k]*M[:, i, k]) > _EPS
+        if frame:
+            a = np.where(regular, np.arctan2( M[:, j, i], -M[:, k, i]), 0.0)
+        else:
+            a = np.where(regular, np.arctan2( M[:, i, j],  M[:, i, k]), np.arctan2(-M[:, j, k],  M[:, j, j]))
+    else:
+        regular = np.sqrt(M[:, i, i]*M[:, i, i] + M[:, j, i]*M[:, j, i]) > _EPS
+        if frame:
+            a = np.where(regular, np.arctan2( M[:, j, i],  M[:, i, i]), 0.0)
+        else:
+            a = np.where(regular, np.arctan2( M[:, k, j],  M[:, k, k]), np.arctan2(-M[:, j, k],  M[:, j, j]))
+
+    if parity:
+        a = -a
+    return a
+
+
 def inv_mat(mat):
     """Inverse of 4x4 transformation matrix. The matrix is a rotation + translation.
 
@@ -370,9 +532,24 @@ def sample_euler_angles_fix_range(num, max_angle1=np.pi, max_angle2=np.pi/2.0, m
     angles: Euler angles (Roll-Pitch-Yaw) [num, 3]
 
     """
-    angle1 = 2 * max_angle1 * np.random.rand(num) - max_angle1
+    rand = np.vstack((np.random.rand(num), np.random.rand(num), np.random.rand(num))).transpose()
+    return euler_angles_fix_range(rand, max_angle1, max_angle2, max_angle3)
+
+
+def euler_angles_fix_range(rand, max_angle1=np.pi, max_angle2=np.pi/2.0, max_angle3=np.pi):
+    """Map uniform random numbers in [0, 1) to Euler angles with restricted range. See sample_euler_angles_fix_range.
+
+    Args:
+    rand: uniform random numbers in [0, 1) [num, 3]
+    max_angle1, max_angle2, max_angle3: maximum positive angle to sample from. Possible values are [0, pi], [0, pi/2] and [0, pi]
+
+    Returns:
+    angles: Euler angles (Roll-Pitch-Yaw) [num, 3]
+
+    """
+    angle1 = 2 * max_angle1 * rand[:, 0] - max_angle1
     a = np.cos(np.pi/2.0 - max_angle2)
-    angle2 = np.arccos((1-2*np.random.rand(num)) * a) - np.pi/2.0
-    angle3 = 2 * max_angle3 * np.random.rand(num) - max_angle3
+    angle2 = np.arccos((1-2*rand[:, 1]) * a) - np.pi/2.0
+    angle3 = 2 * max_angle3 * rand[:, 2] - max_angle3
     angles = np.vstack((angle1, angle2, angle3)).transpose()
-    return angles
\ No newline at end of file
+    return angles
@@ -120,6 +120,38 @@ def extract_all_image_and_label(file_list,
     return filenames, images, landmarks, trans_vecs, quats, pix_dim
 
 
+def stack_images(images):
+    """Stack images of different sizes into one contiguous float32 array. Smaller images are zero-padded at the far corner.
+
+    Args:
+      images: list of img_count 4D numpy arrays with dimensions=[width, height, depth, 1]
+
+    Returns:
+      volumes: zero-padded images. [img_count, max_width, max_height, max_depth]
+      shapes: size of each image. [img_count, 3]
+
+    """
+    shapes = np.array([image.shape[:3] for image in images])
+    volumes = np.zeros((len(images),) + tuple(shapes.max(axis=0)), dtype=np.float32)
+    for i in range(len(images)):
+        volumes[i, :shapes[i, 0], :shapes[i, 1], :shapes[i, 2]] = images[i][:, :, :, 0]
+    return volumes, shapes
+
+
+def quantize_images(volumes, scale):
+    """Quantise images to 8-bit intensities.
+
+    Args:
+      volumes: images with non-negative intensities. [img_count, x, y, z]
+      scale: intensity of one quantisation step. Original intensities are approximately volumes_uint8 * scale
+
+    Returns:
+      volumes_uint8: quantised images. [img_count, x, y, z]
+
+    """
+    return np.clip(np.rint(volumes / scale), 0, 255).astype(np.uint8)
+
+
 def read_data_sets(data_dir,
                    label_dir,
                    train_list_file,
@@ -8,13 +8,15 @@ import tensorflow as tf
 
 
 def weight_variable(shape):
-    initial = tf.truncated_normal(shape, stddev=0.1)
-    return tf.Variable(initial)
+    # Named 'Variable' like the default name of tf.Variable, so that checkpoints saved before the variables were shared still restore
+    initializer = tf.truncated_normal_initializer(stddev=0.1)
+    return tf.get_variable('Variable', shape, initializer=initializer)
 
 
 def bias_variable(shape):
-    initial = tf.constant(0.1, shape=shape)
-    return tf.Variable(initial)
+    # Named 'Variable' like the default name of tf.Variable, so that checkpoints saved before the variables were shared still restore
+    initializer = tf.constant_initializer(0.1)
+    return tf.get_variable('Variable', shape, initializer=initializer)
 
 
 def variable_summaries(var):
@@ -32,7 +34,8 @@ def conv_act_layer(layer_name, input_tensor, input_dim, output_dim,
                     conv_kernel=[3, 3],
                     conv_strides=[1, 1],
                     conv_padding='SAME',
-                    act=tf.nn.relu):
+                    act=tf.nn.relu,
+                    summaries=True):
     """A convolutional layer + an activation layer.
 
     Args:
@@ -44,26 +47,31 @@ def conv_act_layer(layer_name, input_tensor, input_dim, output_dim,
       conv_strides: stride for the convolution
       conv_padding: padding for the convolution
       act: activation layer used
+      summaries: whether to add summaries of the variables and activations
 
     Returns:
       tensor of shape (N_examples, width, height, channel)
 
     """
-    with tf.name_scope(layer_name):
-        with tf.name_scope('weights'):
+    with tf.variable_scope(layer_name):
+        with tf.variable_scope('weights'):
             weights = weight_variable(conv_kernel + [input_dim, output_dim])
-            variable_summaries(weights)
-        with tf.name_scope('biases'):
+            if summaries:
+                variable_summaries(weights)
+        with tf.variable_scope('biases'):
             biases = bias_variable([output_dim])
-            variable_summaries(biases)
+            if summaries:
+                variable_summaries(biases)
         with tf.name_scope('preactivations'):
             preactivate = tf.nn.conv2d(input_tensor, weights,
                                        strides=[1] + conv_strides + [1],
                                        padding=conv_padding) + biases
-            tf.summary.histogram('preactivations', preactivate)
+            if summaries:
+                tf.summary.histogram('preactivations', preactivate)
         with tf.name_scope('activations'):
             activations = act(preactivate, name='activation')
-            tf.summary.histogram('activations', activations)
+            if summaries:
+                tf.summary.histogram('activations', activations)
         return activations
 
 
@@ -71,7 +79,8 @@ def max_pool_layer(layer_name,
                    input_tensor,
                    pool_kernel=[1, 2, 2, 1],
                    pool_strides=[1, 2, 2, 1],
-                   pool_padding='SAME'):
+                   pool_padding='SAME',
+                   summaries=True):
     """max_pooling layer.
 
     Args:
@@ -80,6 +89,7 @@ def max_pool_layer(layer_name,
       pool_kernel: size of pooling kernel
       pool_strides: stride for the pooling
       pool_padding: padding for the 3D pooling
+      summaries: whether to add a summary of the pooled activations
 
     Returns:
       tensor of shape (N_examples, width, height, channel)
@@ -91,11 +101,12 @@ def max_pool_layer(layer_name,
                               strides=pool_strides,
                               padding=pool_padding,
                               name=layer_name)
-        tf.summary.histogram('pool', pool)
+        if summaries:
+            tf.summary.histogram('pool', pool)
         return pool
 
 
-def fc_act_layer(layer_name, input_tensor, input_dim, output_dim, act=tf.nn.relu):
+def fc_act_layer(layer_name, input_tensor, input_dim, output_dim, act=tf.nn.relu, summaries=True):
     """A fully connected layer + an activation layer.
 
     Args:
@@ -104,28 +115,33 @@ def fc_act_layer(layer_name, input_tensor, input_dim, output_dim, act=tf.nn.relu
       input_dim: number of input neurons
       output_dim: number of output neurons
       act: activation layer used
+      summaries: whether to add summaries of the variables and activations
 
     Returns:
       tensor of shape (N_examples, output_dim)
 
     """
-    with tf.name_scope(layer_name):
-        with tf.name_scope('weights'):
+    with tf.variable_scope(layer_name):
+        with tf.variable_scope('weights'):
             weights = weight_variable([input_dim, output_dim])
-            variable_summaries(weights)
-        with tf.name_scope('biases'):
+            if summaries:
+                variable_summaries(weights)
+        with tf.variable_scope('biases'):
             biases = bias_variable([output_dim])
-            variable_summaries(biases)
+            if summaries:
+                variable_summaries(biases)
         with tf.name_scope('preactivations'):
             preactivate = tf.matmul(input_tensor, weights) + biases
-            tf.summary.histogram('preactivations', preactivate)
+            if summaries:
+                tf.summary.histogram('preactivations', preactivate)
         with tf.name_scope('activations'):
             activations = act(preactivate, name='activation')
-            tf.summary.histogram('activations', activations)
+            if summaries:
+                tf.summary.histogram('activations', activations)
         return activations
 
 
-def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr):
+def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr, keep_prob=None, summaries=True):
     """Network for combined classification and regression.
 
     Args:
@@ -135,6 +151,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
       num_output_tr: Dimensions of translation regression output (3 neurons)
       num_output_rc: Dimensions of rotation classification output (6 neurons)
       num_output_rr: Dimensions of rotation regression output. (4 neurons)
+      keep_prob: scalar placeholder for the probability of dropout. Created if not given.
+      summaries: whether to add summaries of the layers
 
     Returns:
       ytc: translation classification output [N_examples, num_output_tc].
@@ -153,12 +171,14 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                              conv_kernel=[3, 3],
                              conv_strides=[1, 1],
                              conv_padding='VALID',
-                             act=tf.nn.relu)
+                             act=tf.nn.relu,
+                             summaries=summaries)
     pool1 = max_pool_layer(layer_name='pool1',
                            input_tensor=conv1_1,
                            pool_kernel=[1, 2, 2, 1],
                            pool_strides=[1, 2, 2, 1],
-                           pool_padding='VALID')
+                           pool_padding='VALID',
+                           summaries=summaries)
 
     # Second convolution block
     conv2_1 = conv_act_layer(layer_name='conv2_1',
@@ -168,12 +188,14 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                              conv_kernel=[3, 3],
                              conv_strides=[1, 1],
                              conv_padding='VALID',
-                             act=tf.nn.relu)
+                             act=tf.nn.relu,
+                             summaries=summaries)
     pool2 = max_pool_layer(layer_name='pool2',
                            input_tensor=conv2_1,
                            pool_kernel=[1, 2, 2, 1],
                            pool_strides=[1, 2, 2, 1],
-                           pool_padding='VALID')
+                           pool_padding='VALID',
+                           summaries=summaries)
 
     # Third convolution block
     conv3_1 = conv_act_layer(layer_name='conv3_1',
@@ -183,12 +205,14 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                              conv_kernel=[3, 3],
                              conv_strides=[1, 1],
                              conv_padding='VALID',
-                             act=tf.nn.relu)
+                             act=tf.nn.relu,
+                             summaries=summaries)
     pool3 = max_pool_layer(layer_name='pool3',
                            input_tensor=conv3_1,
                            pool_kernel=[1, 2, 2, 1],
                            pool_strides=[1, 2, 2, 1],
-                           pool_padding='VALID')
+                           pool_padding='VALID',
+                           summaries=summaries)
 
     # Fourth convolution block
     conv4_1 = conv_act_layer(layer_name='conv4_1',
@@ -198,12 +222,14 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                              conv_kernel=[3, 3],
                              conv_strides=[1, 1],
                              conv_padding='VALID',
-                             act=tf.nn.relu)
+                             act=tf.nn.relu,
+                             summaries=summaries)
     pool4 = max_pool_layer(layer_name='pool4',
                            input_tensor=conv4_1,
                            pool_kernel=[1, 2, 2, 1],
                            pool_strides=[1, 2, 2, 1],
-                           pool_padding='VALID')
+                           pool_padding='VALID',
+                           summaries=summaries)
 
     # Fifth convolution block
     conv5_1 = conv_act_layer(layer_name='conv5_1',
@@ -213,12 +239,14 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                              conv_kernel=[3, 3],
                              conv_strides=[1, 1],
                              conv_padding='VALID',
-                             act=tf.nn.relu)
+                             act=tf.nn.relu,
+                             summaries=summaries)
     pool5 = max_pool_layer(layer_name='pool5',
                            input_tensor=conv5_1,
                            pool_kernel=[1, 2, 2, 1],
                            pool_strides=[1, 2, 2, 1],
-                           pool_padding='VALID')
+                           pool_padding='VALID',
+                           summaries=summaries)
 
     # Reshape final convolution layer
     pre_fc_dim = pool5.get_shape().as_list()[1:]
@@ -234,11 +262,13 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                           input_tensor=pool5_flat,
                           input_dim=fc_input_dim,
                           output_dim=1024,
-                          act=tf.nn.relu)
+                          act=tf.nn.relu,
+                          summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
-        keep_prob = tf.placeholder(tf.float32)
+        if keep_prob is None:
+            keep_prob = tf.placeholder(tf.float32)
         drop1_tc = tf.nn.dropout(fc1_tc, keep_prob)
 
     # Fully connected layer, fc2_tc
@@ -246,7 +276,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                           input_tensor=drop1_tc,
                           input_dim=1024,
                           output_dim=1024,
-                          act=tf.nn.relu)
+                          act=tf.nn.relu,
+                          summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -257,7 +288,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                        input_tensor=drop2_tc,
                        input_dim=1024,
                        output_dim=num_output_tc,
-                       act=tf.identity)
+                       act=tf.identity,
+                       summaries=summaries)
 
     ### Translation Regression layer
     # Fully connected layer, fc1_tr
@@ -265,7 +297,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                           input_tensor=pool5_flat,
                           input_dim=fc_input_dim,
                           output_dim=1024,
-                          act=tf.nn.relu)
+                          act=tf.nn.relu,
+                          summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -276,7 +309,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                           input_tensor=drop1_tr,
                           input_dim=1024,
                           output_dim=1024,
-                          act=tf.nn.relu)
+                          act=tf.nn.relu,
+                          summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -287,7 +321,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                        input_tensor=drop2_tr,
                        input_dim=1024,
                        output_dim=num_output_tr,
-                       act=tf.identity)
+                       act=tf.identity,
+                       summaries=summaries)
 
     ### Rotation Classification layer
     # Fully connected layer, fc1_rc
@@ -295,7 +330,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                          input_tensor=pool5_flat,
                          input_dim=fc_input_dim,
                          output_dim=1024,
-                         act=tf.nn.relu)
+                         act=tf.nn.relu,
+                         summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -306,7 +342,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                          input_tensor=drop1_rc,
                          input_dim=1024,
                          output_dim=1024,
-                         act=tf.nn.relu)
+                         act=tf.nn.relu,
+                         summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -317,7 +354,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                       input_tensor=drop2_rc,
                       input_dim=1024,
                       output_dim=num_output_rc,
-                      act=tf.identity)
+                      act=tf.identity,
+                      summaries=summaries)
 
     ### Rotation Regression layer
     # Fully connected layer, fc1_rr
@@ -325,7 +363,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                          input_tensor=pool5_flat,
                          input_dim=fc_input_dim,
                          output_dim=1024,
-                         act=tf.nn.relu)
+                         act=tf.nn.relu,
+                         summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -336,7 +375,8 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                          input_tensor=drop1_rr,
                          input_dim=1024,
                          output_dim=1024,
-                         act=tf.nn.relu)
+                         act=tf.nn.relu,
+                         summaries=summaries)
 
     # Dropout layer
     with tf.name_scope('dropout'):
@@ -347,6 +387,48 @@ def cnn(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_
                       input_tensor=drop2_rr,
                       input_dim=1024,
                       output_dim=num_output_rr,
-                      act=tf.identity)
+                      act=tf.identity,
+                      summaries=summaries)
+
+    return ytc, ytr, yrc, yrr, keep_prob
+
+
+def cnn_multi_gpu(x, input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr, num_gpus):
+    """Network for combined classification and regression, replicated over several GPUs.
+
+    The mini-batch is split into one tower per GPU. All towers share the same variables and their outputs are
+    concatenated, so the outputs are the same as those of cnn.
+
+    Args:
+      x: an input tensor with the dimensions (N_examples, width, height, channel).
+      input_plane: number of input planes (1 or 3)
+      num_output_tc: Dimensions of translation classification output (6 neurons)
+      num_output_tr: Dimensions of translation regression output (3 neurons)
+      num_output_rc: Dimensions of rotation classification output (6 neurons)
+      num_output_rr: Dimensions of rotation regression output. (4 neurons)
+      num_gpus: number of GPUs
+
+    Returns:
+      ytc: translation classification output [N_examples, num_output_tc].
+      ytr: translation regression output [N_examples, num_output_tr].
+      yrc: rotation classification output [N_examples, num_output_rc].
+      yrr: rotation regression output [N_examples, num_output_rr].
+      keep_prob is a scalar placeholder for the probability of dropout.
+    """
+    with tf.name_scope('dropout'):
+        keep_prob = tf.placeholder(tf.float32)
+
+    # Split the mini-batch as evenly as possible. Works for any number of examples
+    batch_size = tf.shape(x)[0]
+    size_splits = batch_size // num_gpus + tf.cast(tf.range(num_gpus) < batch_size % num_gpus, tf.int32)
+    xs = tf.split(x, size_splits, num=num_gpus)
+
+    outputs = []
+    for i in range(num_gpus):
+        with tf.device('/gpu:%d' % i), tf.name_scope('tower_%d' % i), tf.variable_scope(tf.get_variable_scope(), reuse=i > 0):
+            # Only the first tower adds summaries
+            outputs.append(cnn(xs[i], input_plane, num_output_tc, num_output_tr, num_output_rc, num_output_rr, keep_prob,
+                               summaries=i == 0)[:4])
 
-    return ytc, ytr, yrc, yrr, keep_prob
\ No newline at end of file
+    ytc, ytr, yrc, yrr = [tf.concat(output, axis=0) for output in zip(*outputs)]
+    return ytc, ytr, yrc, yrr, keep_prob
@@ -4,6 +4,11 @@ import numpy as np
 import scipy.ndimage
 from utils import geometry
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def fit_plane(pts):
     """Fit a plane to a set of 3D points.
@@ -196,6 +201,90 @@ def init_mesh_ortho(mesh_siz):
     return xyz_coords
 
 
+def map_coordinates_linear(image, coords):
+    """Trilinear interpolation of a 3D volume at the given coordinates. Points outside the volume are set to zero.
+
+    Same as scipy.ndimage.map_coordinates(image, coords, order=1), but runs as a parallel Numba kernel when Numba is installed.
+
+        Args:
+          image: 3D volume. [x,y,z]
+          coords: coordinates to interpolate at. Origin at volume corner. [3, ...]
+
+        Returns:
+          values: interpolated values [...]
+
+    """
+    if numba is None or not _numba_supported(image.dtype):
+        return scipy.ndimage.map_coordinates(image, coords, order=1)
+    # Numba only compiles arrays in native byte order (eg. big-endian NIfTI volumes are not)
+    image = image.astype(image.dtype.newbyteorder('='), copy=False)
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    values = np.empty(coords.shape[1:], dtype=image.dtype)
+    _map_coordinates_linear(image, coords.reshape(3, -1), values.reshape(-1), np.issubdtype(values.dtype, np.integer))
+    return values
+
+
+def _numba_supported(dtype):
+    # Integer and single/double precision volumes are interpolated by the Numba kernels. Others are left to scipy
+    return dtype.kind in 'iu' or (dtype.kind == 'f' and dtype.itemsize in (4, 8))
+
+
+if numba is not None:
+    @numba.njit(fastmath=True)
+    def _interpolate_linear(image, nx, ny, nz, x, y, z):
+        # Trilinear interpolation at (x, y, z) of the image region [:nx, :ny, :nz]. Zero outside
+        if x < 0 or x > nx-1 or y < 0 or y > ny-1 or z < 0 or z > nz-1:
+            return 0.0
+        # Lower corner of the enclosing voxel cell, clipped so that the upper corner stays inside the volume
+        x0 = min(int(x), nx-2) if nx > 1 else 0
+        y0 = min(int(y), ny-2) if ny > 1 else 0
+        z0 = min(int(z), nz-2) if nz > 1 else 0
+        x1 = min(x0+1, nx-1)
+        y1 = min(y0+1, ny-1)
+        z1 = min(z0+1, nz-1)
+        fx = x - x0
+        fy = y - y0
+        fz = z - z0
+        c00 = image[x0, y0, z0] * (1-fx) + image[x1, y0, z0] * fx
+        c01 = image[x0, y0, z1] * (1-fx) + image[x1, y0, z1] * fx
+        c10 = image[x0, y1, z0] * (1-fx) + image[x1, y1, z0] * fx
+        c11 = image[x0, y1, z1] * (1-fx) + image[x1, y1, z1] * fx
+        c0 = c00 * (1-fy) + c10 * fy
+        c1 = c01 * (1-fy) + c11 * fy
+        return c0 * (1-fz) + c1 * fz
+
+    @numba.njit
+    def _round_half_away(value):
+        # Round half away from zero before the value is truncated to an integer output, as in scipy.ndimage
+        return value + 0.5 if value > 0 else value - 0.5
+
+    @numba.njit(parallel=True, fastmath=True)
+    def _map_coordinates_linear(image, coords, values, round_output):
+        nx, ny, nz = image.shape
+        for n in numba.prange(coords.shape[1]):
+            value = _interpolate_linear(image, nx, ny, nz, coords[0, n], coords[1, n], coords[2, n])
+            values[n] = _round_half_away(value) if round_output else value
+
+    @numba.njit(parallel=True, fastmath=True)
+    def _extract_plane_from_mesh_batch_multi(images, shapes, ind, mats, meshes, slices, round_output):
+        num, num_mesh_pts, mesh_count = slices.shape
+        for n in numba.prange(num * mesh_count):
+            i = n // mesh_count
+            m = n % mesh_count
+            image = images[ind[i]]
+            nx, ny, nz = shapes[ind[i], 0], shapes[ind[i], 1], shapes[ind[i], 2]
+            # Transform the mesh to the volume with its corner as origin
+            mat = mats[i]
+            cx, cy, cz = mat[0, 3] + (nx-1)/2.0, mat[1, 3] + (ny-1)/2.0, mat[2, 3] + (nz-1)/2.0
+            for p in range(num_mesh_pts):
+                px, py, pz = meshes[m, 0, p], meshes[m, 1, p], meshes[m, 2, p]
+                x = mat[0, 0]*px + mat[0, 1]*py + mat[0, 2]*pz + cx
+                y = mat[1, 0]*px + mat[1, 1]*py + mat[1, 2]*pz + cy
+                z = mat[2, 0]*px + mat[2, 1]*py + mat[2, 2]*pz + cz
+                value = _interpolate_linear(image, nx, ny, nz, x, y, z)
+                slices[i, p, m] = _round_half_away(value) if round_output else value
+
+
 def extract_plane_from_mesh(image, mesh, mesh_siz, order):
     """Extract a 2D plane image from the 3D volume given the mesh coordinates of the plane.
 
@@ -222,7 +311,10 @@ def extract_plane_from_mesh(image, mesh, mesh_siz, order):
     new_coords = np.stack((x_coords, y_coords, z_coords), axis=0)
 
     # Extract image plane
-    slice = scipy.ndimage.map_coordinates(image, new_coords, order=order)
+    if order == 1:
+        slice = map_coordinates_linear(image, new_coords)
+    else:
+        slice = scipy.ndimage.map_coordinates(image, new_coords, order=order)
     return slice, new_coords
 
 
@@ -248,7 +340,10 @@ def extract_plane_from_mesh_batch(image, meshes, mesh_siz, order):
     meshes_new = np.reshape(np.transpose(meshes_new, (1, 0, 2))[:3], (3, mesh_count, mesh_siz[0], mesh_siz[1]))      # [3, mesh_count, plane_siz[0], plane_siz[1]]
 
     # Extract image plane
-    slices = scipy.ndimage.map_coordinates(image, meshes_new, order=order)
+    if order == 1:
+        slices = map_coordinates_linear(image, meshes_new)
+    else:
+        slices = scipy.ndimage.map_coordinates(image, meshes_new, order=order)
     meshes_new = np.transpose(meshes_new, (1, 2, 3, 0))
     return slices, meshes_new
 
@@ -281,6 +376,37 @@ def extract_plane_from_mesh_ortho_batch(image, meshes, mesh_siz, order):
     return slices, meshes_new
 
 
+def extract_plane_from_mesh_batch_multi(images, shapes, ind, mats, meshes, mesh_siz):
+    """Extract 2D plane images from several 3D volumes given the transformations of the planes. Do it in a single batch with trilinear interpolation
+
+        Args:
+          images: 3D volumes zero-padded to the same size. Float or 8-bit intensities. [img_count, x, y, z]
+          shapes: size of each volume. [img_count, 3]
+          ind: index of the volume to extract each plane from. [num]
+          mats: 4x4 transformation matrices that map the identity planes to the planes to extract. Origin at volume centre. [num, 4, 4]
+          meshes: mesh coordinates of the identity planes. [mesh_ind, 4, num_mesh_pts]. Origin at volume centre
+          mesh_siz: size of mesh [2]
+
+        Returns:
+          slices: 2D plane images with the same data type as images [num, mesh_siz[0], mesh_siz[1], mesh_ind]
+
+    """
+    num = len(ind)
+    mesh_count = meshes.shape[0]
+    slices = np.empty((num, mesh_siz[0], mesh_siz[1], mesh_count), dtype=images.dtype)
+    if numba is None:
+        for i in range(num):
+            img_siz = shapes[ind[i]]
+            image = images[ind[i], :img_siz[0], :img_siz[1], :img_siz[2]]
+            slices_single, _ = extract_plane_from_mesh_batch(image, np.matmul(mats[i], meshes), mesh_siz, 1)
+            slices[i] = np.transpose(slices_single, (1, 2, 0))
+    else:
+        _extract_plane_from_mesh_batch_multi(images, shapes, np.asarray(ind), mats, meshes,
+                                             slices.reshape(num, mesh_siz[0] * mesh_siz[1], mesh_count),
+                                             np.issubdtype(slices.dtype, np.integer))
+    return slices
+
+
 def extract_plane_from_pose(image, t, q, plane_siz, order):
     """Extract a 2D plane image from the 3D volume given the pose wrt the identity plane.
 